@@ -1,21 +1,37 @@
 """
 .. versionadded:: 3.3
 
-Requires [plumbum](https://plumbum.readthedocs.io/en/latest/)
+Requires [plumbum](https://plumbum.readthedocs.io/en/latest/) 1.8 or later
 """
 from __future__ import with_statement
-from subprocess import TimeoutExpired
+from subprocess import DEVNULL, TimeoutExpired
+import concurrent.futures as c_futures
+import errno
+import functools
+import hashlib
+import io
+import os
+import re
+import selectors
 import sys
-import socket  # noqa: F401
+import socket
+import stat
+import struct
+import threading
+import zipfile
+from collections import OrderedDict, deque
+from rpyc.lib import Timeout
 from rpyc.lib.compat import BYTES_LITERAL
 from rpyc.core.service import VoidService
 from rpyc.core.stream import SocketStream
 import rpyc.utils.factory
 import rpyc.utils.classic
 try:
-    from plumbum import local, ProcessExecutionError, CommandNotFound
+    from plumbum import ProcessExecutionError, CommandNotFound
     from plumbum.commands.base import BoundCommand
-    from plumbum.path import copy
+    from plumbum.machines.local import LocalMachine
+    from plumbum.machines.session import ShellSession
+    from plumbum.machines.ssh_machine import SshTunnel
 except ImportError:
     import inspect
     if any("sphinx" in line[1] or "docutils" in line[1] or "autodoc" in line[1] for line in inspect.stack()):
@@ -30,6 +46,8 @@ import sys
 import os
 import atexit
 import shutil
+import signal
+import socket
 
 here = os.path.dirname(__file__)
 os.chdir(here)
@@ -38,15 +56,24 @@ def rmdir():
     shutil.rmtree(here, ignore_errors = True)
 atexit.register(rmdir)
 
-try:
-    for dirpath, _, filenames in os.walk(here):
-        for fn in filenames:
-            if fn == "__pycache__" or (fn.endswith(".pyc") and os.path.exists(fn[:-1])):
-                os.remove(os.path.join(dirpath, fn))
-except Exception:
-    pass
+# exit cleanly (running the atexit hooks) when terminated, and on Linux, be terminated as soon as
+# the SSH session running the server goes away (which isn't asked for when the server is run
+# locally: its parent is then the deploying process itself, and more precisely the thread that
+# spawned it, which may well exit before the deployment is closed)
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+if os.environ.pop("RPYC_DIE_WITH_SESSION", None) == "1" and sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        PR_SET_PDEATHSIG = 1
+        ctypes.CDLL(None, use_errno = True).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    except Exception:
+        pass
+    else:
+        if os.getppid() == 1:
+            # the session went away before we asked to be told
+            sys.exit(0)
 
-sys.path.insert(0, here)
+sys.path.insert(0, $RPYC_PATH$)
 from $SERVER_MODULE$ import $SERVER_CLASS$ as ServerCls
 from $SERVICE_MODULE$ import $SERVICE_CLASS$ as ServiceCls
 
@@ -56,23 +83,522 @@ $EXTRA_SETUP$
 t = ServerCls(ServiceCls, hostname = "localhost", port = 0, reuse_addr = True, logger = logger)
 thd = t._start_in_thread()
 
-sys.stdout.write(f"{t.port}\n")
+# the deploying side connects to the control socket once it's done setting up, and keeps the
+# connection open for as long as the server should live (if it never does, it kills the server)
+ctrl = socket.socket()
+ctrl.bind(("localhost", 0))
+ctrl.listen(1)
+
+sys.stdout.write(f"{t.port} {ctrl.getsockname()[1]}\n")
 sys.stdout.flush()
 
 try:
-    sys.stdin.read()
+    conn, _ = ctrl.accept()
+    ctrl.close()
+    # acknowledge the connection: through a tunnel, connecting succeeds even if no one's listening
+    conn.sendall(b"+")
+    # returns when told to quit, or when the control connection drops
+    conn.recv(16)
+except OSError:
+    pass
 finally:
     t.close()
     thd.join(2)
 """
 
+# runs on the remote machine: stores the zip read from stdin at the path given as argument, after
+# checking it against the expected SHA256 digest. it is written aside and renamed into place, so
+# concurrent deployments never see a partially-written file
+STORE_SCRIPT = r"""\
+import hashlib, os, sys, tempfile
+dest, digest = sys.argv[1:3]
+os.makedirs(os.path.dirname(dest), exist_ok = True)
+fd, staging = tempfile.mkstemp(dir = os.path.dirname(dest))
+try:
+    sha = hashlib.sha256()
+    with os.fdopen(fd, "wb") as f:
+        for chunk in iter(lambda: sys.stdin.buffer.read(1 << 20), b""):
+            sha.update(chunk)
+            f.write(chunk)
+    if sha.hexdigest() != digest:
+        raise ValueError("corrupted upload")
+    os.replace(staging, dest)
+finally:
+    if os.path.exists(staging):
+        os.remove(staging)
+"""
+
+# matches the placeholders of a server script
+_SCRIPT_PLACEHOLDER = re.compile(r"\$(SERVER_MODULE|SERVER_CLASS|SERVICE_MODULE|SERVICE_CLASS|EXTRA_SETUP|RPYC_PATH)\$")
+
+# the directory (relative to the remote user's home) where deployed RPyC code is cached
+REMOTE_CACHE_DIR = ".rpyc_cache"
+# the size of the chunks in which the RPyC zip is streamed to the remote machine
+UPLOAD_CHUNK_SIZE = 1 << 20
+# upper bound on the number of threads used to deploy/connect/close concurrently
+MAX_CONCURRENCY = 32
+# seconds a shared SSH master connection (see ``share_ssh``) lingers after its last session closes
+SSH_CONTROL_PERSIST = 600
+
+
+@functools.lru_cache(maxsize=32)
+def _render_script(server_script, server_class, service_class, extra_setup, rpyc_path):
+    """Fills in the placeholders of the given server script (in a single pass). ``rpyc_path`` is
+    the remote directory (or zip) containing the ``rpyc`` package. Returns the script encoded as UTF-8
+    (Python's default source encoding), ready to be uploaded as is
+    """
+    server_modname, server_clsname = server_class.rsplit(".", 1)
+    service_modname, service_clsname = service_class.rsplit(".", 1)
+    values = {
+        "SERVER_MODULE": server_modname,
+        "SERVER_CLASS": server_clsname,
+        "SERVICE_MODULE": service_modname,
+        "SERVICE_CLASS": service_clsname,
+        "EXTRA_SETUP": extra_setup,
+        "RPYC_PATH": repr(rpyc_path),
+    }
+    return _SCRIPT_PLACEHOLDER.sub(lambda match: values[match.group(1)], server_script).encode("utf-8")
+
+
+def _map_concurrently(func, items, cleanup=None):
+    """Applies ``func`` to every item using a thread pool and returns the results, in the order
+    of ``items``. All calls are allowed to complete; if any of them failed, ``cleanup`` (if given)
+    is applied to the results of the calls that did succeed, and the first exception is raised
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    # each item is claimed by whichever of the pool and the calling thread gets to it first, so it's
+    # never handled twice (a submit() that fails to start a worker may still have queued its item)
+    claims = [threading.Lock() for _ in items]
+    outcomes = [None] * len(items)
+
+    def call(index):
+        if not claims[index].acquire(blocking=False):
+            return
+        try:
+            outcomes[index] = (True, func(items[index]))
+        except BaseException as ex:
+            outcomes[index] = (False, ex)
+
+    with c_futures.ThreadPoolExecutor(max_workers=min(MAX_CONCURRENCY, len(items))) as executor:
+        for index in range(len(items)):
+            try:
+                executor.submit(call, index)
+            except RuntimeError:
+                # no new threads can be started (e.g., during interpreter shutdown): the items that
+                # didn't make it to the pool are handled right here
+                for rest in range(index, len(items)):
+                    call(rest)
+                break
+    results = [value for succeeded, value in outcomes if succeeded]
+    for succeeded, value in outcomes:
+        if not succeeded:
+            if cleanup is not None:
+                _map_concurrently(cleanup, results)
+            raise value
+    return results
+
+
+def _ssh_destination(remote_machine):
+    """Returns the ``ssh`` command line (sans the command to run) connecting to the given
+    ``SshMachine``, which identifies its destination (host, user, port, identity and options),
+    or ``None`` for other machines
+    """
+    ssh_command = getattr(remote_machine, "_ssh_command", None)
+    if ssh_command is None:
+        return None
+    return tuple(ssh_command.formulate()) + (remote_machine._fqhost,)
+
+
+def _ssh_control_dir():
+    """Returns the directory to keep the sockets of shared SSH master connections in: the user's
+    ``~/.ssh``, as long as no one else can write to it (anyone who could would be able to plant a
+    socket of their own there, and be handed our sessions). Returns ``None`` if it can't be used
+    """
+    if not hasattr(os, "getuid"):
+        return None
+    path = os.path.expanduser("~/.ssh")
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.lstat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+        return None
+    return path
+
+
+def _share_ssh_master(remote_machine):
+    """Makes the ``ssh`` and ``scp`` invocations of the given ``SshMachine`` multiplex their
+    sessions over a single, persistent SSH connection (OpenSSH's ``ControlMaster``), which is
+    shared by all machines connecting to the same destination (host, user, port, identity and
+    options). Returns whether the machine now uses a shared connection (which it keeps using
+    from then on)
+    """
+    argv = _ssh_destination(remote_machine)
+    if argv is None:
+        # ParamikoMachine already runs all of its channels over a single transport
+        return False
+    if any(arg == "-S" or "controlpath" in arg.lower() for arg in argv):
+        # the caller manages connection sharing on its own
+        return False
+    control_dir = _ssh_control_dir()
+    if control_dir is None:
+        return False
+    # keep the socket name short, as UNIX socket paths are limited to ~100 characters
+    digest = hashlib.sha1("\0".join(argv).encode("utf8")).hexdigest()[:16]
+    control_path = os.path.join(control_dir, f"rpyc-{digest}")
+    opts = ("-o", "ControlMaster=auto", "-o", f"ControlPath={control_path}",
+            "-o", f"ControlPersist={SSH_CONTROL_PERSIST}")
+    remote_machine._ssh_command = remote_machine._ssh_command[opts]
+    remote_machine._scp_command = remote_machine._scp_command[opts]
+    return True
+
+
+def _forwarding_opts(local_ports):
+    """Returns the ``ssh`` options forwarding each local port of the given ``{remote_port: local_port}``
+    mapping to its port on the remote machine's ``localhost``
+    """
+    opts = []
+    for remote_port, local_port in local_ports.items():
+        opts.extend(["-L", f"localhost:{local_port}:localhost:{remote_port}"])
+    return opts
+
+
+def _control_forwarding(remote_machine, operation, local_ports, timeout=None):
+    """Asks the shared SSH master of the given machine to ``"forward"`` (or ``"cancel"`` forwarding)
+    the local ports of the given ``{remote_port: local_port}`` mapping
+    """
+    opts = ["-O", operation] + _forwarding_opts(local_ports) + [remote_machine._fqhost]
+    remote_machine._ssh_command[tuple(opts)].run(timeout=timeout)
+
+
+def _alloc_free_ports(n):
+    """Reserves ``n`` free local ports. Returns the sockets bound to them, which hold on to the ports
+    until closed (right before the ports are put to use), along with the ports themselves
+    """
+    socks = []
+    try:
+        for _ in range(n):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            socks.append(sock)
+            sock.bind(("localhost", 0))
+    except Exception:
+        for sock in socks:
+            sock.close()
+        raise
+    return socks, [sock.getsockname()[1] for sock in socks]
+
+
+def _tunnel(remote_machine, local_ports):
+    """Like ``SshMachine.tunnel``, but forwards all the local ports of the given
+    ``{remote_port: local_port}`` mapping over a single SSH session. Builds the ``SshTunnel`` the
+    way plumbum does, which takes its ports as of plumbum 1.8
+    """
+    proc = remote_machine.popen((), ssh_opts=_forwarding_opts(local_ports), new_session=True)
+    session = ShellSession(proc, remote_machine.custom_encoding, connect_timeout=remote_machine.connect_timeout)
+    remote_port, local_port = next(iter(local_ports.items()))
+    return SshTunnel(session, local_port, remote_port, False)
+
+
+def _socks_proxy(remote_machine, reserved=None):
+    """Starts an SSH session acting as a SOCKS proxy (``ssh -D``) into the given ``SshMachine``.
+    ``reserved`` is a ``(socket, port)`` pair, as returned by :func:`_alloc_free_ports`, holding
+    the local port for the proxy to listen on (reserved here, if not given). Returns the session
+    and that port
+    """
+    if reserved is None:
+        (sock,), (port,) = _alloc_free_ports(1)
+    else:
+        sock, port = reserved
+    # the port is only released right before ssh binds it, so nothing else can grab it in the meanwhile
+    sock.close()
+    proc = remote_machine.popen((), ssh_opts=["-D", f"localhost:{port}"], new_session=True)
+    # the session is only up (and the proxy listening) once it ran a command
+    session = ShellSession(proc, remote_machine.custom_encoding, connect_timeout=remote_machine.connect_timeout)
+    return session, port
+
+
+def _recv_exactly(sock, count):
+    data = b""
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise EOFError("connection closed by the SOCKS proxy")
+        data += chunk
+    return data
+
+
+def _socks_connect(proxy_port, port, timeout=3):
+    """Connects to the given port on the remote machine's ``localhost`` through the SOCKS5 proxy
+    listening on the given local port (see :func:`_socks_proxy`)
+    """
+    sock = SocketStream._connect("localhost", proxy_port, timeout=timeout)
+    try:
+        # version 5, offering a single authentication method: none
+        sock.sendall(b"\x05\x01\x00")
+        if _recv_exactly(sock, 2) != b"\x05\x00":
+            raise ConnectionError("the SOCKS proxy rejected the handshake")
+        # CONNECT to a domain name, resolved by the remote end
+        sock.sendall(b"\x05\x01\x00\x03\x09localhost" + struct.pack(">H", port))
+        _, status, _, addr_type = _recv_exactly(sock, 4)
+        if status != 0:
+            raise ConnectionError(f"the SOCKS proxy failed to connect to port {port} (error {status})")
+        # skip the address the proxy bound (IPv4, IPv6 or a length-prefixed domain name) and its port
+        addr_len = {1: 4, 4: 16}.get(addr_type) or _recv_exactly(sock, 1)[0]
+        _recv_exactly(sock, addr_len + 2)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+@functools.lru_cache(maxsize=None)
+def _archive_rpyc():
+    """Packs the sources of the local RPyC package into an uncompressed zip, which is imported
+    as is (with ``zipimport``). Returns the zip's bytes along with their SHA256 digest, which only
+    depends on the packed code (not on when it was packed). The zip is packed once per process,
+    on first use
+    """
+    rpyc_root = os.path.dirname(os.path.abspath(rpyc.__file__))
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for dirpath, dirnames, filenames in os.walk(rpyc_root):
+            dirnames[:] = sorted(name for name in dirnames if name != "__pycache__")
+            for name in sorted(filenames):
+                if not name.endswith(".py"):
+                    continue
+                path = os.path.join(dirpath, name)
+                # a fixed timestamp, so the digest only depends on the contents
+                info = zipfile.ZipInfo("rpyc/" + os.path.relpath(path, rpyc_root).replace(os.sep, "/"))
+                info.external_attr = 0o644 << 16
+                with open(path, "rb") as f:
+                    zf.writestr(info, f.read())
+    data = buf.getvalue()
+    return data, hashlib.sha256(data).hexdigest()
+
+
+def _stream_to(cmd, data):
+    """Runs the given command, streaming ``data`` to its stdin in chunks of ``UPLOAD_CHUNK_SIZE``
+    bytes (instead of spooling it to a temporary file first, as ``cmd << data`` does)
+    """
+    proc = cmd.popen()
+    try:
+        for offset in range(0, len(data), UPLOAD_CHUNK_SIZE):
+            proc.stdin.write(data[offset:offset + UPLOAD_CHUNK_SIZE])
+        if hasattr(proc, "channel"):
+            # ParamikoPopen: closing stdin doesn't signal EOF over the channel
+            proc.stdin.flush()
+            proc.channel.shutdown_write()
+    except (OSError, ValueError):
+        # the command died early; its exit status and output tell why
+        pass
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise ProcessExecutionError(proc.argv, proc.returncode, stdout, stderr)
+
+
+def _deploy_rpyc(remote_machine, python):
+    """Makes sure the local RPyC code is present in the remote machine's cache, uploading it as a
+    single zip (stored remotely by ``python``) unless an identical copy is already cached.
+    Returns the remote path of the zip, which goes on ``sys.path`` as is
+    """
+    data, digest = _archive_rpyc()
+    home = remote_machine.env.home or remote_machine.cwd
+    archive = remote_machine.path(home) / REMOTE_CACHE_DIR / digest / "rpyc.zip"
+    if not archive.is_file():
+        _stream_to(python["-c", STORE_SCRIPT, archive, digest], data)
+    return archive
+
+
+def _read_line(proc, timeout):
+    """Reads the first line written to the given process' stdout, waiting no more than ``timeout``
+    seconds for it (raises ``TimeoutExpired`` otherwise)
+    """
+    if hasattr(proc, "channel"):
+        # ParamikoPopen: the channel implements the timeout
+        proc.channel.settimeout(timeout)
+        try:
+            return proc.stdout.readline()
+        except socket.timeout:
+            raise TimeoutExpired(proc.argv, timeout)
+        finally:
+            proc.channel.settimeout(None)
+    # read the raw pipe (rather than the buffered file object) so select() sees all pending data
+    deadline = Timeout(timeout)
+    fd = proc.stdout.fileno()
+    data = b""
+    with selectors.DefaultSelector() as sel:
+        sel.register(fd, selectors.EVENT_READ)
+        while b"\n" not in data:
+            if not sel.select(deadline.timeleft()):
+                raise TimeoutExpired(proc.argv, timeout)
+            chunk = os.read(fd, 1024)
+            if not chunk:
+                break
+            data += chunk
+    return data
+
+
+def _is_alive(sock):
+    """Checks, without blocking, that the given idle socket (or Paramiko channel) wasn't closed by
+    its peer
+    """
+    if not isinstance(sock, socket.socket):
+        # Paramiko channels take no recv() flags, but keep track of their state themselves
+        return not (sock.closed or sock.eof_received)
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b""
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def _session_proc(obj):
+    """Returns the process running the shell session of the given tunnel or remote machine (if any)"""
+    return getattr(getattr(obj, "_session", None), "proc", None)
+
+
+def _terminate(proc, kill=False):
+    """Tells the given process to exit (or kills it); returns whether it could be told"""
+    if proc is None:
+        return False
+    try:
+        if kill:
+            proc.kill()
+        else:
+            proc.terminate()
+    except Exception:
+        # e.g., ParamikoPopen, which has no way to signal the remote process
+        return False
+    return True
+
+
+def _abort(proc):
+    """Stops the given process, which failed to start, and returns its output (stdout and stderr)"""
+    if hasattr(proc, "channel"):
+        # ParamikoPopen: the remote process can't be signaled, and communicate() would wait for it
+        # to exit. take the output that already arrived, and close the channel instead (which ends
+        # the session, and the server along with it)
+        stdout = stderr = b""
+        while proc.channel.recv_ready():
+            stdout += proc.channel.recv(1 << 16)
+        while proc.channel.recv_stderr_ready():
+            stderr += proc.channel.recv_stderr(1 << 16)
+        if proc.channel.exit_status_ready():
+            proc.wait()
+        else:
+            proc.close()
+        return stdout, stderr
+    try:
+        proc.terminate()
+    except Exception:
+        pass
+    return proc.communicate()
+
+
+def _wait(proc, timeout):
+    """Waits for the given process (which was told to exit) without draining its output. If it
+    doesn't exit within ``timeout`` seconds, it is killed and ``TimeoutExpired`` is raised
+    """
+    try:
+        if hasattr(proc, "channel"):
+            # ParamikoPopen: wait() takes no timeout
+            if not proc.channel.status_event.wait(timeout):
+                raise TimeoutExpired(proc.argv, timeout)
+            proc.wait()
+        else:
+            proc.wait(timeout=timeout)
+    except TimeoutExpired:
+        try:
+            proc.kill()
+        except Exception:
+            pass
+        raise
+    except Exception:
+        pass
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        try:
+            pipe.close()
+        except Exception:
+            pass
+
+
+def _read_lines(procs, timeout):
+    """Like :func:`_read_line`, but for several processes at once: their pipes are all waited on
+    by a single selector (epoll, on Linux). Returns a function per process, returning its first
+    line or raising the error reading it did. Paramiko processes, which have no pipes, are only
+    read when their function is called
+    """
+    readers = [functools.partial(_read_line, proc, timeout) for proc in procs]
+    deadline = Timeout(timeout)
+    data = {}
+    with selectors.DefaultSelector() as sel:
+        for i, proc in enumerate(procs):
+            if not hasattr(proc, "channel"):
+                sel.register(proc.stdout.fileno(), selectors.EVENT_READ, i)
+                data[i] = b""
+        while sel.get_map():
+            events = sel.select(deadline.timeleft())
+            if not events:
+                break
+            for key, _ in events:
+                chunk = os.read(key.fd, 1024)
+                data[key.data] += chunk
+                if not chunk or b"\n" in chunk:
+                    sel.unregister(key.fd)
+                    readers[key.data] = functools.partial(bytes, data[key.data])
+        for key in list(sel.get_map().values()):
+            readers[key.data] = functools.partial(_timed_out, procs[key.data], timeout)
+    return readers
+
+
+def _timed_out(proc, timeout):
+    raise TimeoutExpired(proc.argv, timeout)
+
+
+def _connect_socks(servers, timeout=3):
+    """Connects a socket to each of the given servers' tunnels, issuing all the connection attempts
+    at once and waiting for them together. Returns the sockets in the order of ``servers``, with
+    ``None`` for the servers that aren't tunneled or couldn't be connected to in time
+    """
+    socks = [None] * len(servers)
+    deadline = Timeout(timeout)
+    with selectors.DefaultSelector() as sel:
+        for i, server in enumerate(servers):
+            if server.local_port is None:
+                continue
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            if sock.connect_ex(("localhost", server.local_port)) in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sel.register(sock, selectors.EVENT_WRITE, i)
+            else:
+                sock.close()
+        while sel.get_map() and not deadline.expired():
+            for key, _ in sel.select(deadline.timeleft()):
+                sel.unregister(key.fileobj)
+                if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    key.fileobj.settimeout(timeout)
+                    socks[key.data] = key.fileobj
+                else:
+                    key.fileobj.close()
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+    return socks
+
 
 class DeployedServer(object):
     """
     Sets up a temporary, short-lived RPyC deployment on the given remote machine. It will:
 
-    1. Create a temporary directory on the remote machine and copy RPyC's code
-       from the local machine to the remote temporary directory.
+    1. Upload RPyC's code from the local machine to a cache directory on the remote machine
+       (unless it's already there), and create a temporary directory for the server script.
     2. Start an RPyC server on the remote machine, binding to an arbitrary TCP port,
        allowing only in-bound connections (``localhost`` connections). The server reports the
        chosen port over ``stdout``.
@@ -80,15 +606,32 @@ class DeployedServer(object):
        machine's chosen port. This tunnel is authenticated and encrypted.
     4. You get a ``DeployedServer`` object that can be used to connect to the newly-spawned server.
     5. When the deployment is closed, the SSH tunnel is torn down, the remote server terminates
-       and the temporary directory is deleted.
+       and the temporary directory is deleted (the cached code is kept for the next deployment).
 
     :param remote_machine: a plumbum ``SshMachine`` or ``ParamikoMachine`` instance, representing
-                           an SSH connection to the desired remote machine
+                           an SSH connection to the desired remote machine. plumbum's ``local``
+                           machine is accepted too, for running the server locally: it then uses
+                           the local RPyC code as is, and is connected to directly (no tunnels)
     :param server_class: the server to create (e.g., ``"ThreadedServer"``, ``"ForkingServer"``)
     :param service_class: the service to serve (e.g., ``"SlaveService"``, ...)
     :param server_script: the script that is executed by ``python_executable`` on the remote host
                           to run the server.
     :param extra_setup: any extra code to add to the script
+    :param share_ssh: if ``True``, the SSH sessions used to deploy the server (copying the code,
+                      running the server and tunneling to it) are multiplexed over a single SSH
+                      connection, shared with other deployments to the same host. Only affects
+                      ``SshMachine`` (``ParamikoMachine`` always uses a single connection) and is
+                      skipped if the machine is already configured with a ``ControlPath``. The
+                      machine itself is reconfigured, so it keeps using the shared connection
+                      after the deployment is closed
+    :param startup_timeout: the number of seconds to wait for the server to start up and report
+                            its port (and, once tunneled to, to acknowledge the connection to its
+                            control socket), after which the server is killed and a
+                            ``ProcessExecutionError`` is raised (``None`` means wait forever)
+    :param warm_connections: the number of connections to the server to keep established in the
+                             background, so ``connect()`` and ``classic_connect()`` don't wait for
+                             the connection (and the tunneled SSH channel) to be set up. Each of
+                             them occupies the server as a client would, so this is off by default
     """
 
     def __init__(self,
@@ -97,37 +640,35 @@ class DeployedServer(object):
                  service_class="rpyc.core.service.SlaveService",
                  server_script=SERVER_SCRIPT,
                  extra_setup="",
-                 python_executable=None):
+                 python_executable=None,
+                 share_ssh=False,
+                 startup_timeout=30,
+                 warm_connections=0,
+                 _deferred=False):
         self.proc = None
         self.tun = None
+        self.local_port = None
+        self._remote_ports = []
+        self._local_ports = {}
+        self._control = None
+        self._socks_port = None
+        self._startup_timeout = startup_timeout
+        self._warm_connections = warm_connections
+        self._sock_pool = deque()
+        self._pool_lock = threading.Lock()
+        self._filling_pool = False
         self.remote_machine = remote_machine
         self._tmpdir_ctx = None
-
-        rpyc_root = local.path(rpyc.__file__).up()
-        self._tmpdir_ctx = remote_machine.tempdir()
-        tmp = self._tmpdir_ctx.__enter__()
-        copy(rpyc_root, tmp / "rpyc")
-
-        script = (tmp / "deployed-rpyc.py")
-
-        server_modname, server_clsname = server_class.rsplit(".", 1)
-        service_modname, service_clsname = service_class.rsplit(".", 1)
-
-        for source, target in (
-            ("$SERVER_MODULE$", server_modname),
-            ("$SERVER_CLASS$", server_clsname),
-            ("$SERVICE_MODULE$", service_modname),
-            ("$SERVICE_CLASS$", service_clsname),
-            ("$EXTRA_SETUP$", extra_setup),
-        ):
-            server_script = server_script.replace(source, target)
-
-        script.write(server_script)
+        self._shared_ssh = share_ssh and _share_ssh_master(remote_machine)
+        # a deployment on the local machine needs no uploading nor tunneling
+        self._is_local = isinstance(remote_machine, LocalMachine)
 
         if isinstance(python_executable, BoundCommand):
             cmd = python_executable
         elif python_executable:
             cmd = remote_machine[python_executable]
+        elif self._is_local:
+            cmd = remote_machine[sys.executable]
         else:
             major = sys.version_info[0]
             minor = sys.version_info[1]
@@ -142,26 +683,165 @@ class DeployedServer(object):
             if not cmd:
                 cmd = remote_machine.python
 
-        self.proc = cmd.popen(script, new_session=True)
+        self._tmpdir_ctx = remote_machine.tempdir()
+        tmp = self._tmpdir_ctx.__enter__()
+        if self._is_local:
+            rpyc_path = remote_machine.path(rpyc.__file__).up(2)
+        else:
+            rpyc_path = _deploy_rpyc(remote_machine, cmd)
+        if "$RPYC_PATH$" not in server_script:
+            # a custom script that expects RPyC's code next to it
+            if self._is_local:
+                (rpyc_path / "rpyc").copy(tmp / "rpyc")
+            else:
+                cmd["-c", "import sys, zipfile; zipfile.ZipFile(sys.argv[1]).extractall(sys.argv[2])", rpyc_path, tmp]()
+            rpyc_path = tmp
 
+        script = (tmp / "deployed-rpyc.py")
+        # keyed on the path string, so the cache doesn't hold on to the remote machine
+        script.write(_render_script(server_script, server_class, service_class, extra_setup, str(rpyc_path)))
+
+        # the cached code is shared (and may be read-only), so don't litter it with bytecode; and have
+        # the server's output (e.g., its ports) written out as soon as it's printed
+        server_env = dict(PYTHONDONTWRITEBYTECODE="1", PYTHONUNBUFFERED="1")
+        if not self._is_local:
+            server_env["RPYC_DIE_WITH_SESSION"] = "1"
+        server_cmd = cmd.with_env(**server_env)
+        if server_script == SERVER_SCRIPT and not hasattr(remote_machine, "connect_sock"):
+            # the server doesn't read its stdin, so don't hold a pipe to it. custom scripts may
+            # still live until their stdin closes, and ParamikoPopen takes stdin to be a file to
+            # feed the process with
+            self.proc = server_cmd.popen(script, new_session=True, stdin=DEVNULL)
+        else:
+            self.proc = server_cmd.popen(script, new_session=True)
+
+        # MultiServerDeployment waits for all of its servers to start, and tunnels to them, at once
+        if not _deferred:
+            self._wait_started(functools.partial(_read_line, self.proc, startup_timeout))
+            self._setup_tunnel()
+
+    def _wait_started(self, read_line):
+        """Parses the ports the server reports once started, read by ``read_line()``. If that
+        fails, the server is killed and a ``ProcessExecutionError`` is raised
+        """
+        line = b""
+        try:
+            line = read_line()
+            # the server's port, followed by the port of its control socket (unless a custom
+            # server_script that doesn't have one is used)
+            self._remote_ports = [int(port) for port in line.split()[:2]]
+            self.remote_port = self._remote_ports[0]
+        except Exception:
+            stdout, stderr = _abort(self.proc)
+            if isinstance(line, str):
+                # ParamikoPopen reads text
+                line = BYTES_LITERAL(line)
+            raise ProcessExecutionError(self.proc.argv, self.proc.returncode, line + stdout, stderr)
 
-        if hasattr(remote_machine, "connect_sock"):
-            # Paramiko: use connect_sock() instead of tunnels
+    def _setup_tunnel(self, reserved=None, socks_port=None):
+        """Forwards local ports to the server's ports and connects to its control socket.
+        ``reserved`` is a result of :func:`_alloc_free_ports` holding the local ports to use
+        (reserved here, if not given). If ``socks_port`` is given, the server is reached through
+        the SOCKS proxy listening on it instead (see :func:`_socks_proxy`)
+        """
+        if socks_port is not None:
+            self._socks_port = socks_port
             self.local_port = None
+        elif hasattr(self.remote_machine, "connect_sock") or self._is_local:
+            if reserved is not None:
+                for sock in reserved[0]:
+                    sock.close()
+            if self._is_local:
+                # the server's ports are right here
+                self._local_ports = {port: port for port in self._remote_ports}
+                self.local_port = self.remote_port
+            else:
+                # Paramiko: use connect_sock() instead of tunnels
+                self.local_port = None
         else:
-            line = ""
-            try:
-                line = self.proc.stdout.readline()
-                self.remote_port = int(line.strip())
-            except Exception:
+            socks, ports = reserved or _alloc_free_ports(len(self._remote_ports))
+            local_ports = dict(zip(self._remote_ports, ports))
+            # the ports are only released now, so nothing else can grab them in the meanwhile
+            for sock in socks:
+                sock.close()
+            if self._shared_ssh:
+                # the shared master forwards the ports itself, no need for a session of our own
+                _control_forwarding(self.remote_machine, "forward", local_ports)
+            else:
+                self.tun = _tunnel(self.remote_machine, local_ports)
+            self._local_ports = local_ports
+            self.local_port = local_ports[self.remote_port]
+        if len(self._remote_ports) > 1:
+            self._connect_control()
+        self._refill_pool()
+
+    def _connect_control(self):
+        """Connects to the server's control socket, and waits for the server to acknowledge the
+        connection. If it doesn't, the server is killed and a ``ProcessExecutionError`` is raised
+        """
+        self._control = self._connect_sock(self._remote_ports[1])
+        timeout = self._control.gettimeout()
+        self._control.settimeout(self._startup_timeout)
+        try:
+            ack = self._control.recv(1)
+        except (OSError, EOFError):
+            ack = b""
+        if not ack:
+            self._control.close()
+            self._control = None
+            stdout, stderr = _abort(self.proc)
+            raise ProcessExecutionError(self.proc.argv, self.proc.returncode, stdout, stderr)
+        self._control.settimeout(timeout)
+
+    def _refill_pool(self):
+        """Tops up the pool of established connections (if enabled) in the background"""
+        with self._pool_lock:
+            if self._filling_pool or len(self._sock_pool) >= self._warm_connections:
+                return
+            self._filling_pool = True
+        threading.Thread(target=self._fill_pool, daemon=True).start()
+
+    def _fill_pool(self):
+        try:
+            while True:
+                with self._pool_lock:
+                    if len(self._sock_pool) >= self._warm_connections:
+                        return
+                sock = self._connect_sock()
+                with self._pool_lock:
+                    if len(self._sock_pool) >= self._warm_connections:
+                        # closed in the meanwhile
+                        sock.close()
+                        return
+                    self._sock_pool.append(sock)
+        except Exception:
+            pass
+        finally:
+            with self._pool_lock:
+                self._filling_pool = False
+
+    def _server_sock(self):
+        """Returns a socket connected to the server, taken from the pool of established connections
+        if there's a live one
+        """
+        sock = None
+        with self._pool_lock:
+            while self._sock_pool and sock is None:
+                sock = self._sock_pool.popleft()
                 try:
-                    self.proc.terminate()
+                    alive = _is_alive(sock)
                 except Exception:
-                    pass
-                stdout, stderr = self.proc.communicate()
-                raise ProcessExecutionError(self.proc.argv, self.proc.returncode, BYTES_LITERAL(line) + stdout, stderr)
-            self.local_port = rpyc.utils.factory._get_free_port()
-            self.tun = remote_machine.tunnel(self.local_port, self.remote_port)
+                    alive = False
+                if not alive:
+                    try:
+                        sock.close()
+                    except Exception:
+                        pass
+                    sock = None
+        self._refill_pool()
+        if sock is None:
+            sock = self._connect_sock()
+        return sock
 
     def __del__(self):
         self.close()
@@ -173,35 +853,53 @@ class DeployedServer(object):
         self.close()
 
     def close(self, timeout=None):
-        if self.proc is not None:
+        with self._pool_lock:
+            self._warm_connections = 0
+            pooled, self._sock_pool = self._sock_pool, deque()
+        for sock in pooled:
+            sock.close()
+        stopped = False
+        if self._control is not None:
+            # the server shuts down (and exits) on its own once told to
             try:
-                self.proc.terminate()
-                self.proc.communicate(timeout=timeout)
-            except TimeoutExpired:
-                self.proc.kill()
-                raise
+                self._control.sendall(b"quit")
+                self._control.close()
+                stopped = True
             except Exception:
                 pass
+            self._control = None
+        # tell all the processes to exit before waiting for any of them, so they wind down together
+        tun_proc = _session_proc(self.tun)
+        machine_proc = _session_proc(self.remote_machine)
+        if self.proc is not None and not stopped:
+            stopped = _terminate(self.proc)
+        # the tunnel has nothing to clean up, and ssh may miss a SIGTERM that comes in while it's
+        # tearing down a forwarded connection (e.g., one the server refused)
+        tun_stopped = _terminate(tun_proc, kill=True)
+        machine_stopped = _terminate(machine_proc)
+        if self.proc is not None:
+            if stopped:
+                _wait(self.proc, timeout)
             self.proc = None
         if self.tun is not None:
+            if tun_stopped:
+                _wait(tun_proc, timeout)
             try:
-                self.tun._session.proc.terminate()
-                self.tun._session.proc.communicate(timeout=timeout)
                 self.tun.close()
-            except TimeoutExpired:
-                self.tun._session.proc.kill()
-                raise
             except Exception:
                 pass
             self.tun = None
+        if self._shared_ssh and self.remote_machine is not None and self._local_ports:
+            try:
+                _control_forwarding(self.remote_machine, "cancel", self._local_ports, timeout)
+            except Exception:
+                pass
+            self._local_ports = {}
         if self.remote_machine is not None:
+            if machine_stopped:
+                _wait(machine_proc, timeout)
             try:
-                self.remote_machine._session.proc.terminate()
-                self.remote_machine._session.proc.communicate(timeout=timeout)
                 self.remote_machine.close()
-            except TimeoutExpired:
-                self.remote_machine._session.proc.kill()
-                raise
             except Exception:
                 pass
             self.remote_machine = None
@@ -212,36 +910,147 @@ class DeployedServer(object):
                 pass
             self._tmpdir_ctx = None
 
-    def _connect_sock(self):
-        if self.local_port is None:
+    def _connect_sock(self, remote_port=None):
+        if remote_port is None:
+            remote_port = self.remote_port
+        if self._socks_port is not None:
+            return _socks_connect(self._socks_port, remote_port)
+        elif self.local_port is None:
             # ParamikoMachine
-            return self.remote_machine.connect_sock(self.remote_port)
+            return self.remote_machine.connect_sock(remote_port)
         else:
-            return SocketStream._connect("localhost", self.local_port)
+            return SocketStream._connect("localhost", self._local_ports[remote_port])
 
     def connect(self, service=VoidService, config={}):
         """Same as :func:`~rpyc.utils.factory.connect`, but with the ``host`` and ``port``
         parameters fixed"""
         return rpyc.utils.factory.connect_stream(
-            SocketStream(self._connect_sock()), service=service, config=config)
+            SocketStream(self._server_sock()), service=service, config=config)
 
     def classic_connect(self):
         """Same as :func:`classic.connect <rpyc.utils.classic.connect>`, but with the ``host`` and
         ``port`` parameters fixed"""
         return rpyc.utils.classic.connect_stream(
-            SocketStream(self._connect_sock()))
+            SocketStream(self._server_sock()))
+
+
+class _LazyConnList(object):
+    """A sequence of connections to the given servers, each opened by ``connect(server)`` on first
+    access. No more than ``max_open`` connections are kept open: the least recently used one is
+    closed to make room for a new one
+    """
+
+    def __init__(self, servers, connect, max_open):
+        self._servers = servers
+        self._connect = connect
+        self._max_open = max_open
+        self._conns = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, t, v, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._servers)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            raise TypeError("connections can only be indexed one at a time")
+        index = range(len(self._servers))[index]
+        with self._lock:
+            conn = self._conns.get(index)
+            if conn is None or conn.closed:
+                conn = self._conns[index] = self._connect(self._servers[index])
+            self._conns.move_to_end(index)
+            while len(self._conns) > self._max_open:
+                self._conns.popitem(last=False)[1].close()
+            return conn
+
+    def close(self):
+        """closes all open connections"""
+        with self._lock:
+            conns, self._conns = self._conns, OrderedDict()
+        for conn in conns.values():
+            conn.close()
 
 
 class MultiServerDeployment(object):
     """
     An 'aggregate' server deployment to multiple SSH machine. It deploys RPyC to each machine
-    separately, but lets you manage them as a single deployment.
+    separately (and concurrently), but lets you manage them as a single deployment.
+
+    If ``socks`` is ``True``, each server isn't given tunnels of its own: all the servers on the
+    same host (reached over the same SSH destination) are connected to through a single SOCKS
+    proxy (``ssh -D``) into that host instead. Doesn't affect ``ParamikoMachine`` instances.
+
+    ``startup_timeout`` bounds the wait for all the servers to start, as in :class:`DeployedServer`.
     """
 
-    def __init__(self, remote_machines, server_class="rpyc.utils.server.ThreadedServer"):
+    def __init__(self, remote_machines, server_class="rpyc.utils.server.ThreadedServer", socks=False,
+                 startup_timeout=30):
         self.remote_machines = remote_machines
-        # build the list incrementally, so we can clean it up if we have an exception
-        self.servers = [DeployedServer(mach, server_class) for mach in remote_machines]
+        self.servers = []
+        self._socks_sessions = []
+        # if any deployment fails, the ones that succeeded are closed before the error propagates
+        servers = _map_concurrently(lambda mach: DeployedServer(mach, server_class, startup_timeout=startup_timeout,
+                                                                _deferred=True),
+                                    remote_machines, cleanup=lambda s: s.close())
+        try:
+            # wait for all the servers to report their ports at once
+            readers = _read_lines([s.proc for s in servers], startup_timeout)
+            _map_concurrently(lambda args: args[0]._wait_started(args[1]), zip(servers, readers))
+            if socks:
+                self._setup_socks(servers)
+            else:
+                # reserve the local ports of all the servers in one go, then tunnel to them concurrently
+                port_socks, ports = _alloc_free_ports(sum(len(s._remote_ports) for s in servers))
+                reserved = []
+                for s in servers:
+                    count = len(s._remote_ports)
+                    reserved.append((port_socks[:count], ports[:count]))
+                    port_socks, ports = port_socks[count:], ports[count:]
+                _map_concurrently(lambda args: args[0]._setup_tunnel(args[1]), zip(servers, reserved))
+        except Exception:
+            _map_concurrently(lambda s: s.close(), servers)
+            self._close_socks()
+            raise
+        self.servers = servers
+
+    def _setup_socks(self, servers):
+        # one proxy per SSH destination
+        destinations = {}
+        for s in servers:
+            destination = _ssh_destination(s.remote_machine)
+            if destination is not None:
+                destinations.setdefault(destination, s.remote_machine)
+        # reserve the proxies' local ports in one go, as for tunnels
+        port_socks, ports = _alloc_free_ports(len(destinations))
+        try:
+            proxies = _map_concurrently(lambda args: _socks_proxy(*args),
+                                        zip(destinations.values(), zip(port_socks, ports)),
+                                        cleanup=lambda proxy: proxy[0].close())
+        finally:
+            for sock in port_socks:
+                sock.close()
+        self._socks_sessions = [session for session, _ in proxies]
+        socks_ports = {destination: port for destination, (_, port) in zip(destinations, proxies)}
+        _map_concurrently(lambda s: s._setup_tunnel(socks_port=socks_ports.get(_ssh_destination(s.remote_machine))),
+                          servers)
+
+    def _close_socks(self):
+        sessions, self._socks_sessions = self._socks_sessions, []
+        for session in sessions:
+            try:
+                session.close()
+            except Exception:
+                pass
 
     def __del__(self):
         self.close()
@@ -262,14 +1071,40 @@ class MultiServerDeployment(object):
         return self.servers[index]
 
     def close(self):
-        while self.servers:
-            s = self.servers.pop(0)
-            s.close()
+        servers, self.servers = self.servers, []
+        _map_concurrently(lambda s: s.close(), servers)
+        self._close_socks()
+
+    def _connect_all(self, connect_stream):
+        socks = _connect_socks(self.servers)
+
+        def connect(args):
+            server, sock = args
+            if sock is None:
+                # not tunneled (Paramiko), or the tunnel wasn't ready yet: connect the usual way
+                sock = server._connect_sock()
+            return connect_stream(SocketStream(sock))
+        return _map_concurrently(connect, zip(self.servers, socks), cleanup=lambda conn: conn.close())
 
     def connect_all(self, service=VoidService, config={}):
         """connects to all deployed servers; returns a list of connections (order guaranteed)"""
-        return [s.connect(service, config) for s in self.servers]
+        return self._connect_all(
+            lambda stream: rpyc.utils.factory.connect_stream(stream, service=service, config=config))
 
     def classic_connect_all(self):
         """connects to all deployed servers using classic_connect; returns a list of connections (order guaranteed)"""
-        return [s.classic_connect() for s in self.servers]
+        return self._connect_all(rpyc.utils.classic.connect_stream)
+
+    def connections(self, service=VoidService, config={}, max_open=32):
+        """returns a list-like object of connections to the deployed servers (order guaranteed), each
+        connected on first access. Only the ``max_open`` most recently accessed connections are kept
+        open; older ones are closed"""
+        if max_open < 1:
+            raise ValueError("max_open must be at least 1")
+        return _LazyConnList(self.servers, lambda s: s.connect(service, config), max_open)
+
+    def classic_connections(self, max_open=32):
+        """same as :func:`connections`, but using classic_connect"""
+        if max_open < 1:
+            raise ValueError("max_open must be at least 1")
+        return _LazyConnList(self.servers, lambda s: s.classic_connect(), max_open)
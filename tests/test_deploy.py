@@ -1,12 +1,23 @@
 from __future__ import with_statement
 
+import io
+import os
 import unittest
+from unittest import mock
 import subprocess
+import socket
 import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
-from plumbum import SshMachine
+from plumbum import SshMachine, ProcessExecutionError, local
 from plumbum.machines.paramiko_machine import ParamikoMachine
-from rpyc.utils.zerodeploy import DeployedServer
+import rpyc
+from rpyc.utils.zerodeploy import DeployedServer, MultiServerDeployment, SERVER_SCRIPT
+from rpyc.utils.zerodeploy import _archive_rpyc, _map_concurrently, _read_lines, _render_script, _ssh_control_dir
 from rpyc.core import DEFAULT_CONFIG
 try:
     import paramiko  # noqa
@@ -15,6 +26,42 @@ except Exception:
     _paramiko_import_failed = True
 
 
+# a server script that lives until its stdin closes, as custom scripts written against older
+# versions do
+STDIN_SERVER_SCRIPT = r"""\
+import sys
+import os
+import atexit
+import shutil
+
+here = os.path.dirname(__file__)
+os.chdir(here)
+
+def rmdir():
+    shutil.rmtree(here, ignore_errors = True)
+atexit.register(rmdir)
+
+sys.path.insert(0, here)
+from $SERVER_MODULE$ import $SERVER_CLASS$ as ServerCls
+from $SERVICE_MODULE$ import $SERVICE_CLASS$ as ServiceCls
+
+logger = None
+$EXTRA_SETUP$
+
+t = ServerCls(ServiceCls, hostname = "localhost", port = 0, reuse_addr = True, logger = logger)
+thd = t._start_in_thread()
+
+sys.stdout.write(f"{t.port}\n")
+sys.stdout.flush()
+
+try:
+    sys.stdin.read()
+finally:
+    t.close()
+    thd.join(2)
+"""
+
+
 class TestDeploy(unittest.TestCase):
     def test_deploy(self):
         rem = SshMachine("localhost")
@@ -38,14 +85,14 @@ class TestDeploy(unittest.TestCase):
     def test_close_timeout(self):
         expected_timeout = 4
         observed_timeouts = []
-        original_communicate = subprocess.Popen.communicate
+        original_wait = subprocess.Popen.wait
 
-        def replacement_communicate(self, input=None, timeout=None):
+        def replacement_wait(self, timeout=None):
             observed_timeouts.append(timeout)
-            return original_communicate(self, input, timeout)
+            return original_wait(self, timeout)
 
         try:
-            subprocess.Popen.communicate = replacement_communicate
+            subprocess.Popen.wait = replacement_wait
             rem = SshMachine("localhost")
             rem.env['RPYC_BIND_THREADS'] = str(DEFAULT_CONFIG['bind_threads']).lower()
             SshMachine.python = rem[sys.executable]
@@ -55,21 +102,21 @@ class TestDeploy(unittest.TestCase):
             rem.close()
             conn.close()
         finally:
-            subprocess.Popen.communicate = original_communicate
-        # The last three calls to communicate() happen during close(), so check they
+            subprocess.Popen.wait = original_wait
+        # The last three calls to wait() happen during close(), so check they
         # applied the timeout.
         self.assertEqual(observed_timeouts[-3:], [expected_timeout] * 3)
 
     def test_close_timeout_default_none(self):
         observed_timeouts = []
-        original_communicate = subprocess.Popen.communicate
+        original_wait = subprocess.Popen.wait
 
-        def replacement_communicate(self, input=None, timeout=None):
+        def replacement_wait(self, timeout=None):
             observed_timeouts.append(timeout)
-            return original_communicate(self, input, timeout)
+            return original_wait(self, timeout)
 
         try:
-            subprocess.Popen.communicate = replacement_communicate
+            subprocess.Popen.wait = replacement_wait
             rem = SshMachine("localhost")
             rem.env['RPYC_BIND_THREADS'] = str(DEFAULT_CONFIG['bind_threads']).lower()
             SshMachine.python = rem[sys.executable]
@@ -79,10 +126,265 @@ class TestDeploy(unittest.TestCase):
             rem.close()
             conn.close()
         finally:
-            subprocess.Popen.communicate = original_communicate
-        # No timeout specified, so Popen.communicate should have been called with timeout None.
+            subprocess.Popen.wait = original_wait
+        # No timeout specified, so Popen.wait should have been called with timeout None.
         self.assertEqual(observed_timeouts, [None] * len(observed_timeouts))
 
+    def test_deploy_local(self):
+        with DeployedServer(local) as dep:
+            self.assertIsNone(dep.tun)
+            self.assertEqual(dep.local_port, dep.remote_port)
+            conn = dep.classic_connect()
+            self.assertEqual(conn.modules.rpyc.__file__, rpyc.__file__)
+            self.assertNotEqual(conn.modules.os.getpid(), os.getpid())
+            cwd = conn.modules.os.getcwd()
+            conn.close()
+        self.assertFalse(os.path.exists(cwd))
+
+    def test_deploy_local_from_thread(self):
+        deployments = []
+        thd = threading.Thread(target=lambda: deployments.append(DeployedServer(local)))
+        thd.start()
+        thd.join()
+        with deployments[0] as dep:
+            # the server outlives the thread that spawned it
+            time.sleep(1)
+            self.assertIsNone(dep.proc.poll())
+            conn = dep.classic_connect()
+            self.assertTrue(conn.modules.os.getpid())
+            conn.close()
+
+    def test_deploy_stdin_script(self):
+        rem = SshMachine("localhost")
+        rem.env['RPYC_BIND_THREADS'] = str(DEFAULT_CONFIG['bind_threads']).lower()
+        with DeployedServer(rem, server_script=STDIN_SERVER_SCRIPT) as dep:
+            self.assertIsNone(dep._control)
+            time.sleep(1)
+            self.assertIsNone(dep.proc.poll())
+            conn = dep.classic_connect()
+            self.assertTrue(conn.modules.os.getpid())
+            conn.close()
+
+    def test_deploy_shared_ssh(self):
+        for _ in range(2):
+            rem = SshMachine("localhost")
+            rem.env['RPYC_BIND_THREADS'] = str(DEFAULT_CONFIG['bind_threads']).lower()
+            with DeployedServer(rem, share_ssh=True) as dep:
+                self.assertTrue(dep._shared_ssh)
+                conn = dep.classic_connect()
+                self.assertTrue(conn.modules.os.getpid())
+                local_port = dep.local_port
+                conn.close()
+            # the forwarding was removed from the (still running) shared master
+            with self.assertRaises(OSError):
+                socket.create_connection(("localhost", local_port)).close()
+        # the master's socket is kept where only we can write
+        control_path = [arg for arg in rem._ssh_command.formulate() if arg.startswith("ControlPath=")]
+        self.assertEqual(os.path.dirname(control_path[0][len("ControlPath="):]), os.path.expanduser("~/.ssh"))
+
+    def test_ssh_control_dir(self):
+        with tempfile.TemporaryDirectory() as home, mock.patch.dict(os.environ, HOME=home):
+            self.assertEqual(_ssh_control_dir(), os.path.join(home, ".ssh"))
+            self.assertEqual(os.stat(os.path.join(home, ".ssh")).st_mode & 0o777, 0o700)
+            # others could plant a socket of their own in there
+            os.chmod(os.path.join(home, ".ssh"), 0o777)
+            self.assertIsNone(_ssh_control_dir())
+
+    def _check_warm_connections(self, rem):
+        def pool_filled(dep):
+            for _ in range(50):
+                if len(dep._sock_pool) == 2:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(len(dep._sock_pool), 2)
+            return list(dep._sock_pool)
+
+        def is_closed(sock):
+            # Paramiko channels keep track of it, sockets drop their descriptor
+            return sock.closed if hasattr(sock, "closed") else sock.fileno() == -1
+
+        rem.env['RPYC_BIND_THREADS'] = str(DEFAULT_CONFIG['bind_threads']).lower()
+        with DeployedServer(rem, warm_connections=2) as dep:
+            pooled = pool_filled(dep)
+            conns = [dep.classic_connect() for _ in range(2)]
+            # the connections were made over the pooled sockets, in order
+            self.assertEqual([conn._channel.stream.sock for conn in conns], pooled)
+            self.assertTrue(all(conn.modules.os.getpid() for conn in conns))
+            # and the pool was topped up with new ones
+            refilled = pool_filled(dep)
+            self.assertFalse(set(refilled) & set(pooled))
+            for conn in conns:
+                conn.close()
+        self.assertEqual(len(dep._sock_pool), 0)
+        self.assertTrue(all(is_closed(sock) for sock in refilled))
+
+    def test_warm_connections(self):
+        rem = SshMachine("localhost")
+        self._check_warm_connections(rem)
+        rem.close()
+
+    def test_startup_timeout(self):
+        rem = SshMachine("localhost")
+        t0 = time.time()
+        with self.assertRaises(ProcessExecutionError):
+            DeployedServer(rem, extra_setup="import time; time.sleep(30)", startup_timeout=1)
+        self.assertLess(time.time() - t0, 20)
+        rem.close()
+
+    @unittest.skipIf(_paramiko_import_failed, "Paramiko is not available")
+    def test_startup_timeout_paramiko(self):
+        rem = ParamikoMachine("localhost", missing_host_policy=paramiko.AutoAddPolicy())
+        t0 = time.time()
+        with self.assertRaises(ProcessExecutionError):
+            DeployedServer(rem, extra_setup="import time; time.sleep(30)", startup_timeout=1)
+        self.assertLess(time.time() - t0, 20)
+        rem.close()
+
+    def test_server_gone_before_tunnel(self):
+        rem = SshMachine("localhost")
+        dep = DeployedServer(rem, _deferred=True)
+        try:
+            dep._wait_started(lambda: dep.proc.stdout.readline())
+            # the server goes away before it's tunneled to (the remote machine is this one, so its
+            # control socket can be reached directly)
+            socket.create_connection(("localhost", dep._remote_ports[1])).close()
+            dep.proc.wait(10)
+            # connecting through the tunnel still succeeds, but the server never acknowledges it
+            with self.assertRaises(ProcessExecutionError):
+                dep._setup_tunnel()
+            self.assertIsNone(dep._control)
+        finally:
+            dep.close()
+            rem.close()
+
+    def test_startup_crash(self):
+        with self.assertRaises(ProcessExecutionError) as cm:
+            DeployedServer(local, extra_setup="import nonexistent_mod_xyz")
+        self.assertIn("nonexistent_mod_xyz", cm.exception.stderr)
+
+    def test_archive(self):
+        data, digest = _archive_rpyc()
+        self.assertEqual(_archive_rpyc(), (data, digest))
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            names = zf.namelist()
+        self.assertIn("rpyc/utils/zerodeploy.py", names)
+        self.assertFalse([n for n in names if n.endswith(".pyc") or "__pycache__" in n])
+
+    def test_read_lines(self):
+        python = local[sys.executable]
+        procs = [python["-c", "print(1234, 5678)"].popen(), python["-c", "import time; time.sleep(30)"].popen(),
+                 python["-c", "print(42)"].popen()]
+        try:
+            readers = _read_lines(procs, 2)
+            self.assertEqual(readers[0]().split(), [b"1234", b"5678"])
+            self.assertRaises(subprocess.TimeoutExpired, readers[1])
+            self.assertEqual(readers[2]().strip(), b"42")
+        finally:
+            for proc in procs:
+                proc.kill()
+                proc.communicate()
+
+    def test_map_concurrently_no_threads(self):
+        calls = []
+        original_start = threading.Thread.start
+        started = []
+
+        def start(thd):
+            # only a single worker thread can be started
+            if started:
+                raise RuntimeError("can't start new thread")
+            started.append(thd)
+            original_start(thd)
+
+        with mock.patch.object(threading.Thread, "start", start):
+            results = _map_concurrently(lambda item: calls.append(item) or item * 2, range(5))
+        self.assertEqual(results, [0, 2, 4, 6, 8])
+        self.assertEqual(sorted(calls), [0, 1, 2, 3, 4])
+
+        # the pool stops taking work partway (as it does during interpreter shutdown)
+        del calls[:]
+        original_submit = ThreadPoolExecutor.submit
+
+        def submit(executor, *args):
+            if len(calls) >= 2:
+                raise RuntimeError("cannot schedule new futures after interpreter shutdown")
+            fut = original_submit(executor, *args)
+            fut.result()
+            return fut
+
+        with mock.patch.object(ThreadPoolExecutor, "submit", submit):
+            results = _map_concurrently(lambda item: calls.append(item) or item * 2, range(5))
+        self.assertEqual(results, [0, 2, 4, 6, 8])
+        self.assertEqual(sorted(calls), [0, 1, 2, 3, 4])
+
+    def test_map_concurrently_base_exception(self):
+        class Stop(BaseException):
+            pass
+
+        def func(item):
+            if item == 1:
+                raise Stop()
+            return item
+
+        closed = []
+        with self.assertRaises(Stop):
+            _map_concurrently(func, range(3), cleanup=closed.append)
+        self.assertEqual(sorted(closed), [0, 2])
+
+    def test_render_script(self):
+        script = _render_script(SERVER_SCRIPT, "rpyc.utils.server.ForkingServer", "rpyc.core.service.SlaveService",
+                                "x = '$SERVER_CLASS$'", "/cache/dir").decode("utf-8")
+        self.assertIn("from rpyc.utils.server import ForkingServer as ServerCls", script)
+        self.assertIn("from rpyc.core.service import SlaveService as ServiceCls", script)
+        # the extra setup code is inserted as is
+        self.assertIn("x = '$SERVER_CLASS$'", script)
+        self.assertIn("sys.path.insert(0, '/cache/dir')", script)
+        self.assertEqual(script.count("$"), 2)
+
+    def test_multi_deploy(self):
+        machines = [SshMachine("localhost") for _ in range(3)]
+        for rem in machines:
+            rem.env['RPYC_BIND_THREADS'] = str(DEFAULT_CONFIG['bind_threads']).lower()
+        with MultiServerDeployment(machines) as dep:
+            self.assertEqual(len(dep), 3)
+            conns = dep.classic_connect_all()
+            self.assertEqual(len(conns), 3)
+            cwds = [conn.modules.os.getcwd() for conn in conns]
+            self.assertEqual(len(set(cwds)), 3)
+            for conn in conns:
+                conn.close()
+        self.assertEqual(dep.servers, [])
+
+    def test_multi_deploy_socks(self):
+        machines = [SshMachine("localhost") for _ in range(3)]
+        with MultiServerDeployment(machines, socks=True) as dep:
+            # all the servers share a single proxy
+            self.assertEqual(len(dep._socks_sessions), 1)
+            self.assertTrue(all(s.tun is None for s in dep))
+            conns = dep.classic_connect_all()
+            self.assertEqual(len(set(conn.modules.os.getpid() for conn in conns)), 3)
+            for conn in conns:
+                conn.close()
+        self.assertEqual(dep._socks_sessions, [])
+
+    def test_multi_deploy_connections(self):
+        machines = [SshMachine("localhost") for _ in range(3)]
+        with MultiServerDeployment(machines) as dep:
+            with dep.classic_connections(max_open=2) as conns:
+                self.assertEqual(len(conns), 3)
+                first = conns[0]
+                self.assertIs(conns[0], first)
+                pids = [conn.modules.os.getpid() for conn in conns]
+                self.assertEqual(len(set(pids)), 3)
+                # the least recently used connection was closed to make room
+                self.assertTrue(first.closed)
+                self.assertFalse(conns[-1].closed)
+                self.assertEqual(conns[0].modules.os.getpid(), pids[0])
+                with self.assertRaises(TypeError):
+                    conns[0:2]
+            with self.assertRaises(ValueError):
+                dep.classic_connections(max_open=0)
+
     @unittest.skipIf(_paramiko_import_failed, "Paramiko is not available")
     def test_deploy_paramiko(self):
         rem = ParamikoMachine("localhost", missing_host_policy=paramiko.AutoAddPolicy())
@@ -102,6 +404,12 @@ class TestDeploy(unittest.TestCase):
             self.fail("expected an EOFError")
         rem.close()
 
+    @unittest.skipIf(_paramiko_import_failed, "Paramiko is not available")
+    def test_warm_connections_paramiko(self):
+        rem = ParamikoMachine("localhost", missing_host_policy=paramiko.AutoAddPolicy())
+        self._check_warm_connections(rem)
+        rem.close()
+
 
 if __name__ == "__main__":
     unittest.main()